@@ -150,6 +150,8 @@ class BetaP(P):
         self.sort = sort
         self.rand_sort = rand_sort
 
+        self._probs = {}  # batch size -> inclusion probabilities per beta
+
     def _get_betas(self, K: int):
         assert K > 0, f"Cannot have K of {K}"
 
@@ -162,6 +164,17 @@ class BetaP(P):
 
         return betas
 
+    def _get_probs(self, N: int) -> Iterable[np.ndarray]:
+        # Only depends on N, so we compute it once per batch size
+        if N not in self._probs:
+            probs = []
+            for beta in self.betas:
+                p = beta.pdf(np.linspace(0, 1, N))
+                probs.append((p - p.min()) / (p.max() - p.min()))
+            self._probs[N] = probs
+
+        return self._probs[N]
+
     def __call__(self, batch: Iterable) -> Iterable[Subset]:
         N = batch.shape[0]
 
@@ -172,10 +185,7 @@ class BetaP(P):
             batch = batch[torch.randperm(batch.size()[0])]
 
         subsets = []
-        for beta in self.betas:
-            probs = beta.pdf(np.linspace(0, 1, N))
-            probs = (probs - probs.min()) / (probs.max() - probs.min())
-
+        for probs in self._get_probs(N):
             mask = np.random.binomial(1, probs)
 
             X = batch[mask == 1]
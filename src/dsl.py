@@ -1,3 +1,5 @@
+import math
+
 import numpy as np
 import torch
 import torch.nn as nn
@@ -97,7 +99,111 @@ class NotearsMLP(nn.Module):
         W = torch.sqrt(A)  # [i, j]
         return W
 
+    @torch.inference_mode()
+    def fc1_to_adj(self) -> np.ndarray:
+        W = self.fc1_to_adj_grad()
+        return W.cpu().detach().numpy()
+
+
+# NotearsMLP ensemble with parameters stacked along a leading member dim [K, ...]
+class BatchedNotearsMLP(nn.Module):
+    def __init__(self, K, dims, priors=[]):
+        super(BatchedNotearsMLP, self).__init__()
+        assert len(dims) >= 2
+        assert dims[-1] == 1
+        d = dims[0]
+        self.K = K
+        self.dims = dims
+        self.priors = priors
+
+        # fc1: variable splitting for l1, [K, j * m1, i]
+        self.fc1_pos = nn.Parameter(torch.Tensor(K, d * dims[1], d))
+        self.fc1_neg = nn.Parameter(torch.Tensor(K, d * dims[1], d))
+        self.fc1_pos_bias = nn.Parameter(torch.Tensor(K, d * dims[1]))
+        self.fc1_neg_bias = nn.Parameter(torch.Tensor(K, d * dims[1]))
+        self.fc1_pos.bounds = self._bounds() * K
+        self.fc1_neg.bounds = self._bounds() * K
+        # fc2: local linear layers, [K, d, m1, m2]
+        self.fc2_weight = nn.ParameterList(
+            [
+                nn.Parameter(torch.Tensor(K, d, dims[layer + 1], dims[layer + 2]))
+                for layer in range(len(dims) - 2)
+            ]
+        )
+        self.fc2_bias = nn.ParameterList(
+            [
+                nn.Parameter(torch.Tensor(K, d, dims[layer + 2]))
+                for layer in range(len(dims) - 2)
+            ]
+        )
+
+        self.reset_parameters()
+
     @torch.no_grad()
+    def reset_parameters(self):
+        # Same init as nn.Linear (fc1) and LocallyConnected (fc2) in NotearsMLP
+        bound = 1.0 / math.sqrt(self.dims[0])
+        for p in [self.fc1_pos, self.fc1_neg, self.fc1_pos_bias, self.fc1_neg_bias]:
+            nn.init.uniform_(p, -bound, bound)
+        for weight, bias in zip(self.fc2_weight, self.fc2_bias):
+            bound = 1.0 / math.sqrt(weight.shape[2])
+            nn.init.uniform_(weight, -bound, bound)
+            nn.init.uniform_(bias, -bound, bound)
+
+    # Every member has the same fc1 bounds (and priors) as a NotearsMLP
+    _check = NotearsMLP._check
+    _bounds = NotearsMLP._bounds
+
+    def _fc1_weight(self):  # [K, j * m1, i] -> [K, j, m1, i]
+        d = self.dims[0]
+        fc1_weight = self.fc1_pos - self.fc1_neg
+        return fc1_weight.view(self.K, d, -1, d)
+
+    def forward(self, x):  # [K, n, d] -> [K, n, d]
+        fc1_weight = self.fc1_pos - self.fc1_neg  # [K, j * m1, i]
+        fc1_bias = self.fc1_pos_bias - self.fc1_neg_bias  # [K, j * m1]
+        x = torch.einsum("kni,kji->knj", x, fc1_weight) + fc1_bias.unsqueeze(1)
+        x = x.view(self.K, -1, self.dims[0], self.dims[1])  # [K, n, d, m1]
+        for weight, bias in zip(self.fc2_weight, self.fc2_bias):
+            x = torch.sigmoid(x)  # [K, n, d, m1]
+            # [K, n, d, m2] = [K, n, d, m1] @ [K, d, m1, m2], per member and var
+            x = torch.einsum("kndi,kdio->kndo", x, weight) + bias.unsqueeze(1)
+        x = x.squeeze(dim=3)  # [K, n, d]
+        return x
+
+    def fc1_to_adj_sq(self):  # [K, j * m1, i] -> [K, i, j]
+        """Squared 2-norm of fc1 weights along m1 dim"""
+        fc1_weight = self._fc1_weight()  # [K, j, m1, i]
+        return torch.sum(fc1_weight * fc1_weight, dim=2).transpose(1, 2)
+
+    def h_func(self):
+        """Constrain 2-norm-squared of fc1 weights along m1 dim to be a DAG"""
+        A = self.fc1_to_adj_sq()  # [K, i, j]
+        h = trace_expm(A) - self.dims[0]  # (Zheng et al. 2018)
+        return h
+
+    def l2_reg(self):
+        """Take 2-norm-squared of all parameters"""
+        reg = torch.sum(self._fc1_weight() ** 2, dim=(1, 2, 3))
+        for weight in self.fc2_weight:
+            reg = reg + torch.sum(weight**2, dim=(1, 2, 3))
+        return reg
+
+    def fc1_l1_reg(self):
+        """Take l1 norm of fc1 weight"""
+        return torch.sum(self.fc1_pos + self.fc1_neg, dim=(1, 2))
+
+    def fc1_to_adj_grad(self) -> torch.Tensor:  # [K, j * m1, i] -> [K, i, j]
+        """Get W from fc1 weights, take 2-norm over m1 dim"""
+        A = self.fc1_to_adj_sq()  # [K, i, j]
+        # Entries clamped to zero (e.g. the diagonal) would give a nan
+        #   gradient through sqrt, route them around it instead.
+        nonzero = A > 0
+        W = torch.sqrt(torch.where(nonzero, A, torch.ones_like(A)))
+        W = torch.where(nonzero, W, torch.zeros_like(A))  # [K, i, j]
+        return W
+
+    @torch.inference_mode()
     def fc1_to_adj(self) -> np.ndarray:
         W = self.fc1_to_adj_grad()
         return W.cpu().detach().numpy()
@@ -172,7 +278,7 @@ class NotearsSobolev(nn.Module):
 
         return W
 
-    @torch.no_grad()
+    @torch.inference_mode()
     def fc1_to_adj(self) -> np.ndarray:
         W = self.fc1_to_adj_grad()
         return W.cpu().detach().numpy()
@@ -7,7 +7,43 @@ import torch.nn as nn
 
 import src.utils as ut
 from src.data import P
-from src.dsl import NotearsMLP, NotearsSobolev
+from src.dsl import BatchedNotearsMLP, NotearsMLP, NotearsSobolev
+
+
+def _compile(f: Callable) -> Callable:
+    """torch.compile f, falling back to eager f if compilation fails"""
+    # torch.compile is only available from torch 2.0 onwards
+    if not hasattr(torch, "compile"):
+        return f
+
+    compiled = torch.compile(f, dynamic=False)
+    warm = False
+
+    def wrapped(*args):
+        nonlocal compiled, warm
+        if not warm:
+            # The backward graph is compiled lazily on the first backward,
+            #   so both passes are run once here on detached copies.
+            try:
+                probe = [a.detach().requires_grad_(a.requires_grad) for a in args]
+                with torch.enable_grad():
+                    out = compiled(*probe)
+                    if out.requires_grad:
+                        out.backward()
+            except Exception as e:
+                ut.logger.warning(f"Compiling {f.__name__} failed, running eager: {e}")
+                compiled = f
+            warm = True
+        return compiled(*args)
+
+    return wrapped
+
+
+def _ensemble_mse(As: torch.Tensor, mask: torch.Tensor) -> torch.Tensor:
+    """Off-diagonal MSE of every member against the ensemble mean, summed over K"""
+    A_comp = As.mean(dim=0)  # [d, d]
+    diff = (As - A_comp.unsqueeze(0)) * mask
+    return diff.pow(2).mean(dim=(1, 2)).sum()
 
 
 class NOTEARS(nn.Module):
@@ -58,6 +94,55 @@ class NOTEARS(nn.Module):
         return x_hat, loss
 
 
+class BatchedNOTEARS(nn.Module):
+    def __init__(
+        self,
+        K: int,  # Ensemble members
+        dim: int,  # Dims of system
+        nonlinear_dims: list = [10, 10, 1],  # Dims for non-linear arch
+        rho: float = 1.0,  # NOTEARS parameters
+        alpha: float = 1.0,  # |
+        lambda1: float = 0.0,  # |
+        lambda2: float = 0.0,  # |
+    ):
+        super().__init__()
+
+        self.K = K
+        self.dim = dim
+        self.notears = BatchedNotearsMLP(K, dims=[dim, *nonlinear_dims])
+
+        # Dual ascent state, one entry per member
+        self.register_buffer("rho", torch.full((K,), rho))
+        self.register_buffer("alpha", torch.full((K,), alpha))
+        self.register_buffer("h", torch.full((K,), np.inf))
+        self.lambda1 = lambda1
+        self.lambda2 = lambda2
+
+    def _squared_loss(self, x, x_hat, mask):
+        # Padded rows are masked out, n is the size of each member's subset
+        n = mask.sum(dim=1).clamp(min=1)  # [K]
+        return 0.5 / n * torch.sum((x_hat - x) ** 2 * mask.unsqueeze(2), dim=(1, 2))
+
+    def h_func(self):
+        return self.notears.h_func()
+
+    def loss(self, x, x_hat, mask):
+        loss = self._squared_loss(x, x_hat, mask)  # [K]
+        h_val = self.notears.h_func()  # [K]
+        penalty = 0.5 * self.rho * h_val * h_val + self.alpha * h_val
+        l2_reg = 0.5 * self.lambda2 * self.notears.l2_reg()
+        l1_reg = self.lambda1 * self.notears.fc1_l1_reg()
+
+        return loss + penalty + l2_reg + l1_reg  # [K]
+
+    def forward(self, x: torch.Tensor, mask: torch.Tensor):
+        # x: [K, n, d] padded subsets, mask: [K, n] marks the real rows
+        x_hat = self.notears(x)
+        loss = self.loss(x, x_hat, mask)
+
+        return x_hat, loss
+
+
 class lit_NOTEARS(pl.LightningModule):
     def __init__(
         self,
@@ -70,6 +155,7 @@ class lit_NOTEARS(pl.LightningModule):
         K: int = 5,
         dag_type="ER",
         dim: int = 5,
+        lbfgs_max_iter: int = 15000,
         save_hyperparams: bool = True,
     ):
         super().__init__()
@@ -79,59 +165,61 @@ class lit_NOTEARS(pl.LightningModule):
 
         self.h_tol, self.rho_max = h_tol, rho_max
         self.w_threshold = w_threshold
+        self.lbfgs_max_iter = lbfgs_max_iter
 
         # We need a way to cope with NOTEARS dual
         #   ascent strategy.
         self.automatic_optimization = False
 
+        # s, K, dag_type, dim and n are logged through the hparams
         if save_hyperparams:
             self.save_hyperparameters(ignore=["model"])
 
-        if dag_type == "ER":
-            dag = 1
-        elif dag_type == "SF":
-            dag = 2
-        elif dag_type == "BP":
-            dag = 3
-
-        self.log_dict({"s": s, "dag_type": dag, "dim": dim, "n": n, "K": K})
-
     def _dual_ascent_step(self, x, optimizer: torch.optim.Optimizer) -> Tuple[float]:
         h_new = None
 
-        while self.model.rho < self.rho_max:
-
-            def closure():
-                optimizer.zero_grad()
-                _, loss = self.model(x)
-                self.manual_backward(loss)
-                return loss
+        # rho and alpha are read off the model on every call, so a single
+        #   closure serves all dual ascent iterations.
+        def closure():
+            optimizer.zero_grad()
+            _, loss = self.model(x)
+            self.manual_backward(loss)
+            return loss
 
+        while self.model.rho < self.rho_max:
             optimizer.step(closure)
 
+            # The line search need not end on its last evaluation, so h is
+            #   computed at the accepted iterate.
             with torch.no_grad():
-                h_new = self.model.h_func().item()
-            if h_new > 0.25 * self.h:
+                h_new = self.model.h_func()
+            if (h_new > 0.25 * self.h).item():
                 self.model.rho *= 10
             else:
                 break
+        h_new = h_new.item()
         self.model.alpha += self.model.rho * h_new
         return self.model.alpha, self.model.rho, h_new
 
-    def training_step(self, batch, batch_idx) -> Any:
-        opt = self.optimizers()
+    def on_train_start(self) -> None:
+        # Wrapped once here instead of on every training step
+        self._opt = self.optimizers()
 
+    def training_step(self, batch, batch_idx) -> Any:
         (X,) = batch
 
-        alpha, rho, h = self._dual_ascent_step(X, opt)
+        alpha, rho, h = self._dual_ascent_step(X, self._opt)
         self.h = h
 
-        self.log("h", h, on_step=True, logger=True, prog_bar=True)
-        self.log("rho", rho, on_step=True, logger=True, prog_bar=True)
-        self.log("alpha", alpha, on_step=True, logger=True)
+        self.log_dict(
+            {"h": h, "rho": rho, "alpha": alpha},
+            on_step=True,
+            logger=True,
+            prog_bar=True,
+        )
 
     def configure_optimizers(self) -> torch.optim.Optimizer:
-        return ut.LBFGSBScipy(self.model.parameters())
+        return ut.LBFGSBTorch(self.model.parameters(), max_iter=self.lbfgs_max_iter)
 
     def A(self, grad: bool = False) -> np.ndarray:
         if grad:
@@ -167,10 +255,13 @@ class DStruct(pl.LightningModule):
         h_tol: float = 1e-8,
         rho_max: float = 1e16,
         w_threshold: float = 0.3,
+        lbfgs_max_iter: int = 15000,
+        compile_loss: bool = False,
     ):
         super().__init__()
 
         self.h_tol, self.rho_max, self.w_threshold = h_tol, rho_max, w_threshold
+        self.lbfgs_max_iter = lbfgs_max_iter
 
         self.lr = lr
         self.K = K
@@ -179,37 +270,26 @@ class DStruct(pl.LightningModule):
         self.s = s
 
         self.automatic_optimization = False
-        self.dsl_list = nn.ModuleList([NOTEARS(dim=self.dim) for i in range(self.K)])
-
-        for i, dsl in enumerate(self.dsl_list):
-            self.dsl_list[i].h = np.inf
+        self.dsl = BatchedNOTEARS(K=self.K, dim=self.dim)
+        self.register_buffer("offdiag_mask", 1.0 - torch.eye(self.dim))
+        self._ensemble_mse = _compile(_ensemble_mse) if compile_loss else _ensemble_mse
 
         self.p = p
 
         self.save_hyperparameters()
 
+    def on_train_start(self) -> None:
+        # Wrapped once here instead of on every training step
+        self._opt = self.optimizers()
+
     def training_step(self, batch, batch_idx):
         (X,) = batch
-        subsets = self.p(X)
-
-        opts = self.optimizers()
-        opt = opts[0]
-        opt.zero_grad()
+        x, mask = self._pad(self.p(X))
 
         if self.current_epoch >= 0:
-            hs, rhos, alphas = [], [], []
-            for i, dsl in enumerate(self.dsl_list):
-                subset = subsets[i]
-
-                alpha, rho, h = self._dual_ascent_step(subset, opts[i + 1], dsl)
-                dsl.h = h
+            alphas, rhos, hs = self._dual_ascent_step(x, mask, self._opt)
 
-                hs.append(h)
-                rhos.append(rho)
-                alphas.append(alpha)
-
-            hs, rhos, alphas = np.array(hs), np.array(rhos), np.array(alphas)
-            h, rho, alpha = hs.max(), rhos.min(), alphas.mean()
+            h, rho, alpha = max(hs), min(rhos), sum(alphas) / len(alphas)
 
             self.log_dict({"h": h, "rho": rho, "alpha": alpha})
 
@@ -225,96 +305,140 @@ class DStruct(pl.LightningModule):
         # print(batch_idx)
         # opt.step(closure)
 
+    @staticmethod
+    def _pad(subsets: Iterable[torch.Tensor]) -> Tuple[torch.Tensor, torch.Tensor]:
+        """Stack the ragged subsets into [K, n_max, d] with a [K, n_max] row mask"""
+        x = nn.utils.rnn.pad_sequence(list(subsets), batch_first=True)
+        lengths = torch.tensor([len(subset) for subset in subsets], device=x.device)
+        mask = torch.arange(x.shape[1], device=x.device) < lengths.unsqueeze(1)
+        return x, mask.to(x.dtype)
+
     def _dual_ascent_step(
-        self, x, optimizer: torch.optim.Optimizer, dsl: NOTEARS
-    ) -> Tuple[float]:
+        self, x, mask, optimizer: torch.optim.Optimizer
+    ) -> Tuple[list, list, list]:
         h_new = None
+        dsl = self.dsl
+
+        # Losses of the latest closure evaluation, logged once per step
+        #   instead of on every line search evaluation.
+        losses = {}
+
+        # Members still in their dual ascent step. As in per-member NOTEARS,
+        #   a member is done once its h shrinks enough or rho hits rho_max.
+        #   The active members still share one L-BFGS run, i.e. one step
+        #   size and one set of convergence tests.
+        active = dsl.rho < self.rho_max  # [K]
+
+        def closure():
+            optimizer.zero_grad()
+            _, dsl_loss = dsl(x, mask)
+            dsl_loss = dsl_loss.sum()
+            if self.lmbda != 0:
+                mse_loss = self._loss()
+                loss = dsl_loss + self.lmbda * mse_loss
+            else:
+                # Agreement term is switched off, no need to compute it
+                mse_loss = torch.zeros_like(dsl_loss)
+                loss = dsl_loss
 
-        while dsl.rho < self.rho_max:
+            losses["mse_loss"] = mse_loss.detach()
+            losses["dsl_loss"] = dsl_loss.detach()
+            losses["total_loss"] = loss.detach()
 
-            def closure():
-                optimizer.zero_grad()
-                mse_loss = self._loss()
-                self.log(
-                    "mse_loss",
-                    mse_loss.item(),
-                    on_step=True,
-                    logger=True,
-                    prog_bar=True,
-                )
-                _, loss = dsl(x)
-
-                self.log(
-                    "dsl_loss", loss.item(), on_step=True, logger=True, prog_bar=True
-                )
-                loss += self.lmbda * mse_loss.item()
-                self.log(
-                    "total_loss", loss.item(), on_step=True, logger=True, prog_bar=True
-                )
-
-                self.manual_backward(loss)
-                return loss
+            self.manual_backward(loss)
+
+            # Finished members are frozen, their parameters get no gradient
+            for p in dsl.parameters():
+                p.grad[~active] = 0
+
+            return loss
 
+        while active.any():
             optimizer.step(closure)
 
+            values = torch.stack(list(losses.values())).tolist()
+            self.log_dict(
+                dict(zip(losses.keys(), values)),
+                on_step=True,
+                logger=True,
+                prog_bar=True,
+            )
+
+            # h is computed at the accepted iterate, the line search need not
+            #   end on its last evaluation. It also feeds the alpha update, so
+            #   we keep the exact value rather than a cheaper surrogate.
             with torch.no_grad():
-                h_new = dsl.h_func().item()
-            if h_new > 0.25 * dsl.h:
-                dsl.rho *= 10
-            else:
-                break
+                h_new = dsl.h_func()  # [K]
 
-        dsl.alpha += dsl.rho * h_new
-
-        return dsl.alpha, dsl.rho, h_new
+            # Active members whose h didn't shrink enough get a larger penalty
+            #   and another step, the others are done.
+            escalate = active & (h_new > 0.25 * dsl.h)
+            dsl.rho[escalate] *= 10
+            active = escalate & (dsl.rho < self.rho_max)
 
-    def configure_optimizers(self) -> Iterable[torch.optim.Optimizer]:
-        dsl_optimizers = [ut.LBFGSBScipy(dsl.parameters()) for dsl in self.dsl_list]
+        dsl.alpha += dsl.rho * h_new
+        dsl.h = h_new
 
-        self_optim = ut.LBFGSBScipy(self.dsl_list.parameters())
+        return dsl.alpha.tolist(), dsl.rho.tolist(), h_new.tolist()
 
-        return tuple([self_optim, *dsl_optimizers])
+    def configure_optimizers(self) -> torch.optim.Optimizer:
+        return ut.LBFGSBTorch(self.dsl.parameters(), max_iter=self.lbfgs_max_iter)
 
     def forward(self, threshold=0.5, grad: bool = True):
         if grad:
-            As = tuple([dsl.notears.fc1_to_adj_grad() for dsl in self.dsl_list])
-            _As = torch.stack(As).mean(dim=0)
+            As = self.dsl.notears.fc1_to_adj_grad()  # [K, d, d]
+            _As = As.mean(dim=0)
         else:
-            As = np.array([dsl.notears.fc1_to_adj() for dsl in self.dsl_list])
+            with torch.inference_mode():
+                As = self.dsl.notears.fc1_to_adj_grad()
 
-            _As = As.mean(axis=0)
-
-            _As[np.abs(_As) > threshold] = 1
-            _As[np.abs(_As) <= threshold] = 0
+            _As = self._threshold(As.mean(dim=0), threshold)
+            As = As.cpu().numpy()
 
         return As, _As
 
-    def _loss(self):
-        As, A_comp = self.forward()
-
-        mask = torch.ones(A_comp.shape)
-        mask.diagonal().zero_()
+    @staticmethod
+    def _threshold(A: torch.Tensor, threshold: float) -> np.ndarray:
+        # Threshold on device, only the [d, d] result is moved to the host
+        return (A.abs() > threshold).to(A.dtype).cpu().numpy()
 
-        A_comp.detach()
-        A_comp.diagonal().zero_()
+    def _loss(self):
+        As, _ = self.forward()  # [K, d, d]
 
-        loss = 0
-        mse = nn.MSELoss()
-        for A_est in As:
-            loss += mse(A_est * mask, A_comp)
-        return loss
+        return self._ensemble_mse(As, self.offdiag_mask)
 
     def A(self, threshold=0.5) -> np.ndarray:
         _, A = self.forward(threshold=threshold, grad=False)
         return A
 
     def test_step(self, batch, batch_idx) -> Any:
-        for threshold in np.linspace(start=0, stop=1, num=100):
-            B_est = self.A(threshold)
-            if ut.is_dag(B_est):
-                print(f"Is DAG for {threshold}")
-                self.log_dict({"DAG_threshold": threshold})
-                break
+        with torch.inference_mode():
+            A_mean = self.dsl.notears.fc1_to_adj_grad().mean(dim=0)
+        thresholds = np.linspace(start=0, stop=1, num=100)
+
+        # Raising the threshold only removes edges, so is_dag is monotone
+        #   in it: bisect for the smallest threshold that gives a DAG.
+        lo, hi = 0, len(thresholds) - 1
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if ut.is_dag(self._threshold(A_mean, thresholds[mid])):
+                hi = mid
+            else:
+                lo = mid + 1
+
+        threshold = thresholds[lo]
+        B_est = self._threshold(A_mean, threshold)
+        if ut.is_dag(B_est):
+            print(f"Is DAG for {threshold}")
+            self.log_dict({"DAG_threshold": threshold})
+        else:
+            # Edge weights can exceed 1, fall back on the empty graph so
+            #   count_accuracy is always given a DAG.
+            ut.logger.warning(
+                f"No DAG for thresholds up to {thresholds[-1]}, using the empty graph"
+            )
+            self.log_dict({"DAG_threshold": thresholds[-1]})
+            B_est = np.zeros_like(B_est)
 
         B_true = self.trainer.datamodule.DAG
         print(f"B_est: {B_est}")
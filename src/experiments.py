@@ -126,6 +126,12 @@ def experiment(
 @click.option(
     "--rand_sort", type=bool, default="False", help="bool - random sort batches."
 )
+@click.option(
+    "--compile_loss",
+    type=bool,
+    default="False",
+    help="bool - torch.compile the D-Struct ensemble MSE.",
+)
 @click.option(
     "--experiment_count", type=int, default=5, help="Amount of seq. experiments to run."
 )
@@ -144,6 +150,7 @@ def main(
     nt_rho_max,
     sort,
     rand_sort,
+    compile_loss,
     experiment_count,
 ):
     torch.set_default_dtype(torch.double)
@@ -217,6 +224,7 @@ def main(
                     "n": n,
                     "s": s,
                     "dag_type": graph_type,
+                    "compile_loss": compile_loss,
                 },
                 "train": {
                     "max_epochs": epochs,
@@ -7,16 +7,19 @@ class TraceExpm(torch.autograd.Function):
     @staticmethod
     def forward(ctx, input):
         # detach so we can cast to NumPy
-        E = slin.expm(input.cpu().detach().numpy())
-        f = np.trace(E)
-        E = torch.from_numpy(E)
+        A = input.cpu().detach().numpy()
+        # supports a leading batch of matrices, [..., d, d] -> [...]
+        E = np.stack([slin.expm(a) for a in A.reshape(-1, *A.shape[-2:])])
+        E = E.reshape(A.shape)
+        f = np.trace(E, axis1=-2, axis2=-1)
+        E = torch.from_numpy(E).to(input.device)
         ctx.save_for_backward(E)
-        return torch.as_tensor(f, dtype=input.dtype)
+        return torch.as_tensor(f, dtype=input.dtype, device=input.device)
 
     @staticmethod
     def backward(ctx, grad_output):
         (E,) = ctx.saved_tensors
-        grad_input = grad_output * E.t()
+        grad_input = grad_output[..., None, None] * E.transpose(-2, -1)
         return grad_input
 
 
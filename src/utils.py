@@ -215,6 +215,94 @@ class LBFGSBScipy(torch.optim.Optimizer):
         self._distribute_flat_params(final_params)
 
 
+class LBFGSBTorch(torch.optim.LBFGS):
+    """L-BFGS with the box constraints of LBFGSBScipy, kept on device.
+
+    Parameters carrying a `bounds` attribute are projected onto their box
+    after every update, so both the line search trial points and the
+    accepted iterate are feasible. Gradients of coordinates held at a
+    bound (pointing out of the box, or fixed by a (0, 0) bound) are zeroed.
+    This is projected L-BFGS rather than L-BFGS-B: the search direction may
+    still push an active coordinate out of the box, the projection then
+    holds it at its bound. The defaults mirror scipy's L-BFGS-B (maxiter,
+    maxfun, gtol and maxcor), and like LBFGSBScipy every step starts from
+    a fresh curvature history and runs until one of the tolerances fires.
+    """
+
+    def __init__(
+        self,
+        params,
+        max_iter: int = 15000,
+        max_eval: int = None,
+        tolerance_grad: float = 1e-5,
+        tolerance_change: float = 1e-9,
+        history_size: int = 10,
+        line_search_fn: str = "strong_wolfe",
+        **kwargs,
+    ):
+        super(LBFGSBTorch, self).__init__(
+            params,
+            max_iter=max_iter,
+            # scipy caps evaluations (maxfun) at the same value as iterations
+            max_eval=max_iter if max_eval is None else max_eval,
+            tolerance_grad=tolerance_grad,
+            tolerance_change=tolerance_change,
+            history_size=history_size,
+            line_search_fn=line_search_fn,
+            **kwargs,
+        )
+
+        self._bounds = []
+        for p in self._params:
+            if hasattr(p, "bounds"):
+                lower = [-math.inf if lo is None else lo for lo, _ in p.bounds]
+                upper = [math.inf if up is None else up for _, up in p.bounds]
+                lower = torch.tensor(lower, dtype=p.dtype, device=p.device)
+                upper = torch.tensor(upper, dtype=p.dtype, device=p.device)
+                self._bounds.append((p, lower.view_as(p), upper.view_as(p)))
+
+    @torch.no_grad()
+    def _project(self):
+        for p, lower, upper in self._bounds:
+            p.copy_(torch.min(torch.max(p, lower.to(p)), upper.to(p)))
+
+    @torch.no_grad()
+    def _mask_grad(self):
+        for p, lower, upper in self._bounds:
+            if p.grad is None:
+                continue
+            lower, upper = lower.to(p), upper.to(p)
+            active = (
+                ((p <= lower) & (p.grad > 0))
+                | ((p >= upper) & (p.grad < 0))
+                | (lower == upper)
+            )
+            p.grad.masked_fill_(active, 0)
+
+    def _add_grad(self, step_size, update):
+        # Every update, trial point or accepted iterate, lands in the box
+        super(LBFGSBTorch, self)._add_grad(step_size, update)
+        self._project()
+
+    def step(self, closure):
+        """Performs a single optimization step.
+        Arguments:
+            closure (callable): A closure that reevaluates the model
+                and returns the loss.
+        """
+        self.state[self._params[0]].clear()
+
+        # Freshly initialised parameters need not lie in their box yet
+        self._project()
+
+        def masked_closure():
+            loss = closure()
+            self._mask_grad()
+            return loss
+
+        return super(LBFGSBTorch, self).step(masked_closure)
+
+
 # Zheng et al.
 class LocallyConnected(nn.Module):
     """Local linear layer, i.e. Conv1dLocal() with filter size 1.